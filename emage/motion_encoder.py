@@ -139,9 +139,8 @@ class LocalEncoder(nn.Module):
 
 
 def reparameterize(mu, logvar):
-    std = torch.exp(0.5 * logvar)
-    eps = torch.randn_like(std)
-    return mu + eps * std
+    # mu + eps * std with the multiply-add done by a single addcmul
+    return torch.addcmul(mu, torch.randn_like(logvar), torch.exp(0.5 * logvar))
 
 
 class VAEConv(nn.Module):
@@ -1,10 +1,63 @@
 import math
 import torch
 import torch.nn as nn
-from torch.nn.utils import weight_norm
+import torch.nn.functional as F
+from torch.nn.utils import weight_norm, remove_weight_norm
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+import torch.ao.nn.intrinsic as nni
+from torch.ao.nn.quantized import FloatFunctional
+from torch.ao.quantization import QuantWrapper, convert, fuse_modules, get_default_qconfig, prepare
 from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
 
+_compiled_fns = {}
+
+
+def compiled(fn, **kwargs):
+    """
+    torch.compile ``fn`` lazily, once per function and options (torch>=2.0, ``fn`` itself otherwise).
+    modules with ``use_compile`` call the unbound method through this cache, so nothing compiled is
+    stored on the module: deepcopy, pickling and state_dict keys are unaffected.
+    dynamo guards on the module object, so every instance traces its own graph and counts against
+    torch._dynamo.config.cache_size_limit. nn.DataParallel builds new replicas on every forward and
+    recompiles each step until that limit, then silently runs eager, use DistributedDataParallel instead.
+    """
+    if not hasattr(torch, "compile"):
+        return fn
+    key = (fn, tuple(sorted(kwargs.items())))
+    if key not in _compiled_fns:
+        _compiled_fns[key] = torch.compile(fn, **kwargs)
+    return _compiled_fns[key]
+
+
+def to_channels_last_1d(x):
+    # [N, C, L] with channel-fastest strides, the 1d analogue of torch.channels_last
+    return x.unsqueeze(2).contiguous(memory_format=torch.channels_last).squeeze(2)
+
+
+def convert_conv1d_weight_memory_format(module):
+    """
+    move every Conv1d weight of ``module`` to the channels-last 1d layout (weight_v for
+    weight-normed convs), norm layers are left untouched.
+    based on torch.nn.utils.convert_conv2d_weight_memory_format
+    """
+    for m in module.modules():
+        if isinstance(m, nn.Conv1d):
+            weight = m.weight_v if hasattr(m, "weight_g") else m.weight
+            weight.data = to_channels_last_1d(weight.data)
+        elif isinstance(m, TemporalConvNet):
+            # a captured graph would still read the old weight storage
+            m._cuda_graph = None
+    return module
+
+
+def causal_pad(x, left_pad: int):
+    if x.stride(1) == 1:
+        # pad the time axis of the [N, L, C] view so a channels-last 1d input keeps its layout
+        return F.pad(x.transpose(1, 2), [0, 0, left_pad, 0]).transpose(1, 2)
+    return F.pad(x, [left_pad, 0])
+
+
 class Chomp1d(nn.Module):
     def __init__(self, chomp_size):
         super(Chomp1d, self).__init__()
@@ -15,21 +68,26 @@ class Chomp1d(nn.Module):
 
 
 class TemporalBlock(nn.Module):
+    kernel_size: torch.jit.Final[int]
+    left_pad: torch.jit.Final[int]
+    p: torch.jit.Final[float]
+
     def __init__(self, n_inputs, n_outputs, kernel_size, stride, dilation, padding, dropout=0.2):
         super(TemporalBlock, self).__init__()
-        self.conv1 = weight_norm(nn.Conv1d(n_inputs, n_outputs, kernel_size, stride=stride, padding=padding, dilation=dilation))
-        self.chomp1 = Chomp1d(padding)
+        # causal conv: pad on the left only instead of padding both sides and chomping the right
+        self.kernel_size = kernel_size
+        self.left_pad = padding
+        self.conv1 = weight_norm(nn.Conv1d(n_inputs, n_outputs, kernel_size, stride=stride, padding=0, dilation=dilation))
         self.relu1 = nn.ReLU()
-        self.dropout1 = nn.Dropout(dropout)
 
-        self.conv2 = weight_norm(nn.Conv1d(n_outputs, n_outputs, kernel_size, stride=stride, padding=padding, dilation=dilation))
-        self.chomp2 = Chomp1d(padding)
+        self.conv2 = weight_norm(nn.Conv1d(n_outputs, n_outputs, kernel_size, stride=stride, padding=0, dilation=dilation))
         self.relu2 = nn.ReLU()
-        self.dropout2 = nn.Dropout(dropout)
+        # one dropout mask per residual branch instead of one after each conv
+        self.p = dropout
 
-        self.net = nn.Sequential(self.conv1, self.chomp1, self.relu1, self.dropout1, self.conv2, self.chomp2, self.relu2, self.dropout2)
         self.downsample = nn.Conv1d(n_inputs, n_outputs, 1) if n_inputs != n_outputs else None
-        self.relu = nn.ReLU()
+        # residual add + relu, swapped for the quantized add_relu op by quantize_text_encoder
+        self.skip_add = FloatFunctional()
         self.init_weights()
 
     def init_weights(self):
@@ -38,14 +96,42 @@ class TemporalBlock(nn.Module):
         if self.downsample is not None:
             self.downsample.weight.data.normal_(0, 0.01)
 
+    def remove_wn(self):
+        # bake g * v / ||v|| into a plain weight, call after loading checkpoints
+        for conv in (self.conv1, self.conv2):
+            if hasattr(conv, "weight_g"):
+                remove_weight_norm(conv)
+        return self
+
+    def fuse_relu(self):
+        # conv1/conv2 become nn.intrinsic.ConvReLU1d so the backend runs relu as a conv post-op
+        assert not self.training, "fuse_relu only works in eval mode"
+        self.remove_wn()
+        if not isinstance(self.conv1, nni.ConvReLU1d):
+            fuse_modules(self, [["conv1", "relu1"], ["conv2", "relu2"]], inplace=True)
+        return self
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints also store conv1/conv2 under the removed ``net`` Sequential
+        for key in [k for k in state_dict if k.startswith(prefix + "net.")]:
+            del state_dict[key]
+        super(TemporalBlock, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
-        out = self.net(x)
-        res = x if self.downsample is None else self.downsample(x)
-        return self.relu(out + res)
+        out = self.relu1(self.conv1(causal_pad(x, self.left_pad)))
+        out = self.relu2(self.conv2(causal_pad(out, self.left_pad)))
+        if self.training and self.p > 0:
+            out = F.dropout(out, self.p, True)
+        res = x
+        if self.downsample is not None:
+            res = self.downsample(x)
+        return self.skip_add.add_relu(out, res)
 
 
 class TemporalConvNet(nn.Module):
-    def __init__(self, num_inputs, num_channels, kernel_size=2, dropout=0.2):
+    num_levels: torch.jit.Final[int]
+
+    def __init__(self, num_inputs, num_channels, kernel_size=2, dropout=0.2, use_compile=False, channels_last=False):
         super(TemporalConvNet, self).__init__()
         layers = []
         num_levels = len(num_channels)
@@ -66,9 +152,98 @@ class TemporalConvNet(nn.Module):
             ]
 
         self.network = nn.Sequential(*layers)
+        self.num_levels = num_levels
+        self.channels_last = channels_last
+        if channels_last:
+            convert_conv1d_weight_memory_format(self.network)
+        # (graph, static_input, static_output, parameter data_ptrs), set by capture()
+        self._cuda_graph = None
+        self.use_compile = use_compile
+
+    def remove_wn(self):
+        """
+        bake the weight norm of every block into plain weights for inference. this renames the
+        conv parameters, so call it after load_state_dict and never on a model that is still trained.
+        """
+        for block in self.network:
+            block.remove_wn()
+        if self.channels_last:
+            convert_conv1d_weight_memory_format(self.network)
+        self._cuda_graph = None
+        return self
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to()/.cuda()/.half() replace the parameter storage a captured graph points at
+        self._cuda_graph = None
+        return super(TemporalConvNet, self)._apply(fn, *args, **kwargs)
+
+    def _param_ptrs(self):
+        return tuple(p.data_ptr() for p in self.parameters())
+
+    def to_torchscript(self):
+        # weight norm hooks can't be scripted
+        return torch.jit.script(self.remove_wn().eval())
+
+    def capture(self, example_input, warmup=3):
+        """
+        record the eval-mode forward for ``example_input`` into a CUDA graph, forward replays it
+        under no_grad for inputs of the same shape, dtype and device and falls back otherwise.
+        removes the weight norm first (see remove_wn), so call it after load_state_dict.
+        """
+        assert not self.training and example_input.is_cuda, "capture needs an eval-mode model and a CUDA input"
+        # reduce-overhead compilation does its own CUDA graph capture, it can't be nested in this one
+        assert not self.use_compile, "capture can't be combined with use_compile"
+        self.remove_wn()
+        static_input = example_input.clone()
+        with torch.no_grad():
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(warmup):
+                    self._forward_impl(static_input)
+            torch.cuda.current_stream().wait_stream(stream)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_output = self._forward_impl(static_input)
+        self._cuda_graph = (graph, static_input, static_output, self._param_ptrs())
+        return self
+
+    @torch.jit.unused
+    def _can_replay(self, x: torch.Tensor) -> bool:
+        if self._cuda_graph is None or self.training or torch.is_grad_enabled():
+            return False
+        if self._param_ptrs() != self._cuda_graph[3]:
+            # parameters were swapped after capture (fuse_relu, quantization, .data assignment)
+            self._cuda_graph = None
+            return False
+        static_input = self._cuda_graph[1]
+        return x.shape == static_input.shape and x.dtype == static_input.dtype and x.device == static_input.device
+
+    @torch.jit.unused
+    def _replay(self, x: torch.Tensor) -> torch.Tensor:
+        graph, static_input, static_output, _ = self._cuda_graph
+        static_input.copy_(x)
+        graph.replay()
+        # the static output is overwritten by the next replay
+        return static_output.clone()
+
+    @torch.jit.unused
+    def _compiled_network(self, x: torch.Tensor) -> torch.Tensor:
+        return compiled(nn.Sequential.forward, mode="reduce-overhead", dynamic=False)(self.network, x)
+
+    def _forward_impl(self, x):
+        if self.channels_last:
+            x = to_channels_last_1d(x)
+        if not torch.jit.is_scripting() and self.use_compile:
+            out = self._compiled_network(x)
+        else:
+            out = self.network(x)
+        return out.contiguous() if self.channels_last else out
 
     def forward(self, x):
-        return self.network(x)
+        if not torch.jit.is_scripting() and self._can_replay(x):
+            return self._replay(x)
+        return self._forward_impl(x)
 
 
 class TextEncoderTCN(nn.Module):
@@ -78,32 +253,75 @@ class TextEncoderTCN(nn.Module):
     """
 
     def __init__(
-        self, args, n_words=11195, embed_size=300, pre_trained_embedding=None, kernel_size=2, dropout=0.3, emb_dropout=0.1, word_cache=False
+        self,
+        args,
+        n_words=11195,
+        embed_size=300,
+        pre_trained_embedding=None,
+        kernel_size=2,
+        dropout=0.3,
+        emb_dropout=0.1,
+        word_cache=False,
+        use_compile=False,
     ):
         super(TextEncoderTCN, self).__init__()
         num_channels = [args.hidden_size]  # * args.n_layer
         self.tcn = TemporalConvNet(embed_size, num_channels, kernel_size, dropout=dropout)
+        # emb_dropout is kept for signature compatibility, forward never applied an embedding dropout
         self.decoder = nn.Linear(num_channels[-1], args.word_f)
-        self.drop = nn.Dropout(emb_dropout)
         self.init_weights()
+        self.use_compile = use_compile
 
     def init_weights(self):
         self.decoder.bias.data.fill_(0)
         self.decoder.weight.data.normal_(0, 0.01)
 
+    @torch.jit.unused
+    def _compiled_forward(self, input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return compiled(TextEncoderTCN._forward_impl, dynamic=False)(self, input)
+
     def forward(self, input):
+        if not torch.jit.is_scripting() and self.use_compile:
+            return self._compiled_forward(input)
+        return self._forward_impl(input)
+
+    def _forward_impl(self, input):
         y = self.tcn(input.transpose(1, 2)).transpose(1, 2)
         y = self.decoder(y)
-        return y, torch.max(y, dim=1)[0]
+        return y, y.amax(dim=1)
+
+
+def quantize_text_encoder(model, calib_loader, backend="x86"):
+    """
+    post-training static int8 quantization of the TCN inside a TextEncoderTCN, in place.
+    the decoder stays in fp32, ``calib_loader`` yields embedded inputs (or tuples starting with them).
+    """
+    model.eval()
+    model.tcn.remove_wn()
+    for block in model.tcn.network:
+        block.fuse_relu()
+    torch.backends.quantized.engine = backend
+    model.tcn = QuantWrapper(model.tcn)
+    model.tcn.qconfig = get_default_qconfig(backend)
+    prepare(model.tcn, inplace=True)
+    with torch.no_grad():
+        for batch in calib_loader:
+            model(batch[0] if isinstance(batch, (list, tuple)) else batch)
+    convert(model.tcn, inplace=True)
+    return model
 
 
 def reparameterize(mu, logvar):
-    std = torch.exp(0.5 * logvar)
-    eps = torch.randn_like(std)
-    return mu + eps * std
+    # mu + eps * std with the multiply-add done by a single addcmul
+    return torch.addcmul(mu, torch.randn_like(logvar), torch.exp(0.5 * logvar))
+
 
+def GroupNorm1d(num_channels):
+    # norm_layer for BasicBlock/ConvNormRelu on small batches, one fused kernel and no running stats
+    return nn.GroupNorm(math.gcd(32, num_channels), num_channels)
 
-def ConvNormRelu(in_channels, out_channels, downsample=False, padding=0, batchnorm=True):
+
+def ConvNormRelu(in_channels, out_channels, downsample=False, padding=0, batchnorm=True, norm_layer=nn.BatchNorm1d):
     if not downsample:
         k = 3
         s = 1
@@ -111,14 +329,58 @@ def ConvNormRelu(in_channels, out_channels, downsample=False, padding=0, batchno
         k = 4
         s = 2
     conv_block = nn.Conv1d(in_channels, out_channels, kernel_size=k, stride=s, padding=padding)
-    norm_block = nn.BatchNorm1d(out_channels)
     if batchnorm:
-        net = nn.Sequential(conv_block, norm_block, nn.LeakyReLU(0.2, True))
+        net = nn.Sequential(conv_block, norm_layer(out_channels), nn.LeakyReLU(0.2, True))
     else:
         net = nn.Sequential(conv_block, nn.LeakyReLU(0.2, True))
     return net
 
 
+class FusedConvLReLU1d(nn.Module):
+    """
+    Conv1d + LeakyReLU as one F.conv1d followed by an in-place leaky_relu, fuse_model builds it
+    from eval-mode ConvNormRelu blocks once the BatchNorm is folded into ``weight``/``bias``.
+    takes already trained ``weight`` [out, in, k] and ``bias`` [out], use from_conv to build it.
+    """
+
+    stride: torch.jit.Final[int]
+    padding: torch.jit.Final[int]
+    negative_slope: torch.jit.Final[float]
+
+    def __init__(self, weight, bias, stride=1, padding=0, negative_slope=0.2):
+        super(FusedConvLReLU1d, self).__init__()
+        self.weight = nn.Parameter(weight) if not isinstance(weight, nn.Parameter) else weight
+        self.bias = nn.Parameter(bias) if not isinstance(bias, nn.Parameter) else bias
+        self.stride = stride
+        self.padding = padding
+        self.negative_slope = negative_slope
+
+    @classmethod
+    def from_conv(cls, conv, negative_slope=0.2):
+        # shares the (BN-folded) conv parameters
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(conv.weight[:, 0, 0])
+        return cls(conv.weight, bias, conv.stride[0], conv.padding[0], negative_slope)
+
+    def forward(self, x):
+        return F.leaky_relu(F.conv1d(x, self.weight, self.bias, self.stride, self.padding), self.negative_slope, inplace=True)
+
+
+def _is_conv_lrelu(m):
+    # the nn.Sequential built by ConvNormRelu, with the BatchNorm (if any) already folded away
+    if not isinstance(m, nn.Sequential) or len(m) < 2:
+        return False
+    conv, act = m[0], m[-1]
+    return (
+        type(conv) is nn.Conv1d
+        and conv.groups == 1
+        and conv.dilation == (1,)
+        and conv.padding_mode == "zeros"
+        and not isinstance(conv.padding, str)
+        and isinstance(act, nn.LeakyReLU)
+        and all(isinstance(mid, nn.Identity) for mid in m[1:-1])
+    )
+
+
 class BasicBlock(nn.Module):
     """
     based on timm: https://github.com/huggingface/pytorch-image-models/blob/f689c850b90b16a45cc119a7bc3b24375636fc63/timm/models/resnet.py#L34
@@ -143,6 +405,7 @@ class BasicBlock(nn.Module):
         aa_layer: Optional[Type[nn.Module]] = None,
         drop_block: Optional[Type[nn.Module]] = None,
         drop_path: Optional[nn.Module] = None,
+        use_compile: bool = False,
     ):
         super(BasicBlock, self).__init__()
 
@@ -169,12 +432,36 @@ class BasicBlock(nn.Module):
         self.drop_block = drop_block
         self.drop_path = drop_path
         # Until here
+        self.use_compile = use_compile
 
     def zero_init_last(self):
         if getattr(self.bn2, "weight", None) is not None:
             nn.init.zeros_(self.bn2.weight)
 
+    def fuse_bn(self):
+        """
+        fold the eval-mode BatchNorm1d layers into the preceding Conv1d weights/bias,
+        bn1/bn2 (and the downsample norm) become nn.Identity.
+        """
+        assert not self.training, "fuse_bn only works in eval mode"
+        if isinstance(self.bn1, nn.BatchNorm1d):
+            self.conv1, self.bn1 = fuse_conv_bn_eval(self.conv1, self.bn1), nn.Identity()
+        if isinstance(self.bn2, nn.BatchNorm1d):
+            self.conv2, self.bn2 = fuse_conv_bn_eval(self.conv2, self.bn2), nn.Identity()
+        if self.downsample is not None and isinstance(self.downsample[1], nn.BatchNorm1d):
+            self.downsample[0], self.downsample[1] = fuse_conv_bn_eval(self.downsample[0], self.downsample[1]), nn.Identity()
+        return self
+
+    @torch.jit.unused
+    def _compiled_forward(self, x: torch.Tensor) -> torch.Tensor:
+        return compiled(BasicBlock._forward_impl, dynamic=False)(self, x)
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if not torch.jit.is_scripting() and self.use_compile:
+            return self._compiled_forward(x)
+        return self._forward_impl(x)
+
+    def _forward_impl(self, x: torch.Tensor) -> torch.Tensor:
         shortcut = x
         """
         Original Layer Sequence:
@@ -195,6 +482,47 @@ class BasicBlock(nn.Module):
         return x
 
 
+def fuse_model(net, conv_lrelu=True):
+    """
+    fold every eval-mode Conv1d -> BatchNorm1d pair of ``net`` in place,
+    covers BasicBlock and the nn.Sequential built by ConvNormRelu,
+    TemporalBlock convs lose their weight norm and are fused with their ReLU,
+    so like TemporalConvNet.remove_wn this runs after load_state_dict.
+    with ``conv_lrelu`` the folded ConvNormRelu blocks are replaced by FusedConvLReLU1d.
+    """
+    assert not net.training, "fuse_model only works in eval mode"
+    for m in list(net.modules()):
+        if isinstance(m, BasicBlock):
+            m.fuse_bn()
+        elif isinstance(m, TemporalConvNet):
+            m.remove_wn()
+        elif isinstance(m, TemporalBlock):
+            m.fuse_relu()
+        elif isinstance(m, nn.Sequential):
+            for i in range(len(m) - 1):
+                if isinstance(m[i], nn.Conv1d) and isinstance(m[i + 1], nn.BatchNorm1d):
+                    m[i], m[i + 1] = fuse_conv_bn_eval(m[i], m[i + 1]), nn.Identity()
+    if conv_lrelu:
+        for parent in list(net.modules()):
+            for name, child in list(parent.named_children()):
+                if _is_conv_lrelu(child):
+                    setattr(parent, name, FusedConvLReLU1d.from_conv(child[0], child[-1].negative_slope))
+    return net
+
+
+def optimize_for_cpu(model, dtype=torch.bfloat16):
+    """
+    fold BN/ReLU with fuse_model, then let Intel Extension for PyTorch rewrite the remaining
+    Conv1d -> (Leaky)ReLU chains into fused oneDNN primitives. returns the optimized model.
+    """
+    import intel_extension_for_pytorch as ipex
+
+    model.eval()
+    # keep the Conv1d modules so IPEX can match them
+    fuse_model(model, conv_lrelu=False)
+    return ipex.optimize(model, dtype=dtype)
+
+
 def init_weight(m):
     if isinstance(m, nn.Conv1d) or isinstance(m, nn.Linear) or isinstance(m, nn.ConvTranspose1d):
         nn.init.xavier_normal_(m.weight)
@@ -209,7 +537,7 @@ def init_weight_skcnn(m):
         # m.bias.data.fill_(0.01)
         if m.bias is not None:
             # nn.init.constant_(m.bias, 0)
-            fan_in, _ = nn.init._calculate_fan_in_and_fan_out(m.weight)
+            fan_in = m.weight.shape[1:].numel()  # in_channels * kernel_size, same as _calculate_fan_in_and_fan_out
             bound = 1 / math.sqrt(fan_in)
             nn.init.uniform_(m.bias, -bound, bound)
 